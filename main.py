@@ -1,113 +1,351 @@
 import os
-import base64
+import atexit
 import json
-from io import BytesIO
-from flask import Flask, render_template, request, session, redirect, url_for
+import hashlib
+import math
+import queue
+import struct
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from fnmatch import fnmatch
+from flask import Flask, render_template, request, session, redirect, url_for, make_response, send_from_directory, abort
 import matplotlib.pyplot as plt
+from matplotlib.ticker import MaxNLocator
+import numpy as np
+import orjson
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
-app.secret_key = os.urandom(24)
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
-# --- History File ---
-HISTORY_FILE = 'pm25_history.json'
+# --- Server-side sessions: with REDIS_URL set, the cookie only carries a session ID ---
+if os.environ.get('REDIS_URL'):
+    import redis
+    from flask_session import Session
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.from_url(os.environ['REDIS_URL'])
+    Session(app)
+
+# --- History File (one JSON object per line) ---
+HISTORY_FILE = 'pm25_history.jsonl'
+LEGACY_HISTORY_FILE = 'pm25_history.json'
 
 # --- Model Factors ---
 BASE_PM25_LEVEL, TRAFFIC_FACTOR, INDUSTRY_FACTOR, BURNING_FACTOR, WIND_DISPERSION_FACTOR = 5.0, 0.025, 1.6, 0.12, 0.08
 
+# --- Model inputs; kept in the session as four little-endian doubles to keep the cookie small ---
+Inputs = namedtuple('Inputs', 'traffic industry burning wind')
+_INPUTS_STRUCT = struct.Struct('<4d')
+
+def _pack_inputs(inputs):
+    return _INPUTS_STRUCT.pack(*inputs)
+
+def _unpack_inputs(data):
+    return Inputs._make(_INPUTS_STRUCT.unpack(data))
+
+# --- Form actions that run the model; "clear" is handled separately ---
+SCENARIO_ACTIONS = ('scenario_traffic', 'scenario_burning', 'scenario_wind')
+
+# --- Air quality levels: inclusive upper bounds and the (level, message, css_class) for each band ---
+_THRESHOLDS = (12.0, 35.4, 55.4)
+_LEVELS = (
+    ("ดี", "คุณภาพอากาศดีมาก", "good"),
+    ("ปานกลาง", "ผู้ที่ต้องดูแลสุขภาพเป็นพิเศษควรลดเวลาทำกิจกรรมกลางแจ้ง", "fair"),
+    ("เริ่มมีผลกระทบต่อสุขภาพ", "กลุ่มเสี่ยงควรลดเวลาทำกิจกรรมกลางแจ้ง", "poor"),
+    ("มีผลกระทบต่อสุขภาพ", "ทุกคนควรเฝ้าระวังและลดเวลาการทำกิจกรรมกลางแจ้ง", "poor"),
+)
+
 plt.switch_backend('Agg')
 plt.rcParams['font.family'] = 'sans-serif'
 
+# --- Persistent figures, redrawn in place for every chart (pyplot is not thread-safe) ---
+_CHART_LOCK = threading.Lock()
+_BAR_FIG, _BAR_AX = plt.subplots(figsize=(8, 4.5))
+_LINE_FIG, _LINE_AX = plt.subplots(figsize=(8, 4.5))
+
 # --- Helper functions for history ---
-def load_history():
-    """Loads calculation history from a JSON file."""
+def _is_valid_entry(entry):
+    """True if every model input and the PM2.5 value of a history entry is a finite number."""
+    return isinstance(entry, dict) and all(
+        isinstance(entry.get(k), (int, float)) and math.isfinite(entry[k]) for k in (*Inputs._fields, 'pm25_value'))
+
+def _read_history_file():
+    """Reads the calculation history from the JSONL file, skipping unreadable or incomplete lines."""
     if not os.path.exists(HISTORY_FILE):
         return []
+    history = []
+    with open(HISTORY_FILE, 'rb') as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            if _is_valid_entry(entry):
+                history.append(entry)
+    return history
+
+def _migrate_legacy_history():
+    """One-time import of the old single-array JSON history into the JSONL file."""
+    if not os.path.exists(LEGACY_HISTORY_FILE) or (os.path.exists(HISTORY_FILE) and os.path.getsize(HISTORY_FILE)):
+        return
     try:
-        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(LEGACY_HISTORY_FILE, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
     except (json.JSONDecodeError, FileNotFoundError):
-        return []
+        return
+    tmp_path = f"{HISTORY_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        for entry in legacy if isinstance(legacy, list) else []:
+            if _is_valid_entry(entry):
+                f.write(orjson.dumps(entry) + b'\n')
+    os.replace(tmp_path, HISTORY_FILE)
+    try:
+        os.replace(LEGACY_HISTORY_FILE, LEGACY_HISTORY_FILE + '.bak')
+    except FileNotFoundError:
+        pass  # another worker migrated it first
+
+def _history_stat():
+    try:
+        st = os.stat(HISTORY_FILE)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+# The parsed history is cached in memory and re-read only when the file changes, so
+# several worker processes sharing the file stay consistent. Disk writes are handed
+# to a background thread so requests never wait on I/O.
+_migrate_legacy_history()
+_HISTORY_LOCK = threading.Lock()
+_HISTORY_STAT = _history_stat()
+_HISTORY_CACHE = _read_history_file()
+_HISTORY_WRITES = queue.Queue()
+
+def _history_writer():
+    """Applies queued history writes in order: bytes are appended, None truncates."""
+    while True:
+        line = _HISTORY_WRITES.get()
+        try:
+            with open(HISTORY_FILE, 'wb' if line is None else 'ab') as f:
+                if line is not None:
+                    f.write(line)
+        except OSError as e:
+            app.logger.error("Could not write history file: %s", e)
+        finally:
+            _HISTORY_WRITES.task_done()
+
+threading.Thread(target=_history_writer, name='history-writer', daemon=True).start()
+atexit.register(_HISTORY_WRITES.join)
+
+def load_history():
+    """Returns a snapshot of the calculation history, re-reading the file if another process changed it."""
+    global _HISTORY_STAT
+    with _HISTORY_LOCK:
+        # While this process still has queued writes, its cache is ahead of the file.
+        if not _HISTORY_WRITES.unfinished_tasks:
+            stat = _history_stat()
+            if stat != _HISTORY_STAT:
+                _HISTORY_STAT = stat
+                _HISTORY_CACHE[:] = _read_history_file()
+        return list(_HISTORY_CACHE)
+
+def save_entry(entry):
+    """Appends a single calculation to the cache and queues it for the history file."""
+    with _HISTORY_LOCK:
+        _HISTORY_CACHE.append(entry)
+        _HISTORY_WRITES.put(orjson.dumps(entry) + b'\n')
+
+def clear_history():
+    """Empties the cache and queues truncation of the history file."""
+    with _HISTORY_LOCK:
+        _HISTORY_CACHE.clear()
+        _HISTORY_WRITES.put(None)
+
+def _page_version():
+    """Digest of the app code and the page templates, so a deploy that changes them invalidates old ETags."""
+    digest = hashlib.md5()
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    for path in (__file__, os.path.join(template_dir, 'base.html'), os.path.join(template_dir, 'python_apps.html')):
+        try:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        except FileNotFoundError:
+            continue
+    return digest.digest()
+
+_PAGE_VERSION = _page_version()
+
+def history_etag(history_json):
+    """ETag for the GET page, which is fully determined by the page version and the serialized history."""
+    return hashlib.md5(_PAGE_VERSION + history_json).hexdigest()
+
+
+# --- Charts: content-addressed SVG files under static/charts; an existing file is never redrawn ---
+CHART_DIR = os.path.join(app.static_folder, 'charts')
+os.makedirs(CHART_DIR, exist_ok=True)
+# Every new history produces a new trend chart, so only the most recent charts of each kind are kept.
+MAX_CHARTS_PER_KIND = 64
+
+def _chart_digest(key):
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
 
-def save_history(history):
-    """Saves calculation history to a JSON file."""
-    with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(history, f, indent=4, ensure_ascii=False)
+def line_chart_signature(pm_values):
+    """Identifies the trend chart for a sequence of PM2.5 values."""
+    return _chart_digest(repr(tuple(pm_values)))
 
+def _chart_path(kind, digest):
+    """Returns the file name and disk path of a chart in CHART_DIR."""
+    filename = f"{kind}_{digest}.svg"
+    return filename, os.path.join(CHART_DIR, filename)
+
+def _bar_chart_path(pm25_value):
+    return _chart_path('bar', _chart_digest(f"{pm25_value:.1f}"))
+
+# Data behind recently issued chart URLs, so a lazy-loaded image can still be drawn
+# after other users have moved the shared history on.
+MAX_ISSUED_CHARTS = 256
+_ISSUED_CHARTS = OrderedDict()
+_ISSUED_CHARTS_LOCK = threading.Lock()
+
+def _issue_chart(kind, key, data):
+    with _ISSUED_CHARTS_LOCK:
+        _ISSUED_CHARTS[kind, key] = data
+        _ISSUED_CHARTS.move_to_end((kind, key))
+        while len(_ISSUED_CHARTS) > MAX_ISSUED_CHARTS:
+            _ISSUED_CHARTS.popitem(last=False)
+
+def _issued_chart(kind, key):
+    with _ISSUED_CHARTS_LOCK:
+        return _ISSUED_CHARTS.get((kind, key))
+
+def prune_charts(pattern='*.svg', keep=0):
+    """Deletes all but the `keep` most recently written chart files matching `pattern`."""
+    charts = []
+    for entry in os.scandir(CHART_DIR):
+        if fnmatch(entry.name, pattern):
+            try:
+                charts.append((entry.stat().st_mtime_ns, entry.path))
+            except FileNotFoundError:
+                continue
+    charts.sort()
+    for _, path in charts[:max(len(charts) - keep, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _save_chart(fig, path):
+    """Writes the figure next to its final path and renames it, so readers never see a partial file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fig.savefig(tmp_path, format="svg")
+    os.replace(tmp_path, path)
+
+# The AQI bars, labels and grid never change, so the bar chart background is drawn once;
+# each chart only moves the latest-value line.
+_AQI_LEVELS = {'Good': 12.0, 'Moderate': 35.4, 'Unhealthy (Sensitive)': 55.4, 'Unhealthy': 150.4}
+_BAR_AX.bar(list(_AQI_LEVELS.keys()), list(_AQI_LEVELS.values()), color=['#00e400', '#ffff00', '#ff7e00', '#ff0000'],
+            width=0.5, alpha=0.7, label='AQI Level Thresholds')
+_BAR_LINE = _BAR_AX.axhline(y=0, color='#007bff', linestyle='--', linewidth=2.5)
+_BAR_AX.set_ylabel('PM2.5 Concentration (µg/m³)')
+_BAR_AX.set_title('Latest Value vs. AQI Levels')
+plt.setp(_BAR_AX.get_xticklabels(), rotation=10, ha="right")
+_BAR_AX.grid(axis='y', linestyle='--', alpha=0.7)
+_BAR_FIG.tight_layout()
 
 def create_pm25_bar_chart(pm25_value):
-    levels = {'Good': 12.0, 'Moderate': 35.4, 'Unhealthy (Sensitive)': 55.4, 'Unhealthy': 150.4}
-    level_names, thresholds = list(levels.keys()), list(levels.values())
-    colors = ['#00e400', '#ffff00', '#ff7e00', '#ff0000']
-    fig, ax = plt.subplots(figsize=(8, 4.5))
-    ax.bar(level_names, thresholds, color=colors, width=0.5, alpha=0.7, label='AQI Level Thresholds')
-    ax.axhline(y=pm25_value, color='#007bff', linestyle='--', linewidth=2.5, label=f'Latest Value: {pm25_value:.1f}')
-    ax.set_ylabel('PM2.5 Concentration (µg/m³)')
-    ax.set_title('Latest Value vs. AQI Levels')
-    plt.xticks(rotation=10, ha="right")
-    ax.legend()
-    ax.grid(axis='y', linestyle='--', alpha=0.7)
-    plt.tight_layout()
-    buf = BytesIO()
-    fig.savefig(buf, format="png")
-    data = base64.b64encode(buf.getbuffer()).decode("ascii")
-    plt.close(fig)
-    return data
-
-def create_pm25_line_chart(history):
-    if not history: return None
-    pm_values = [item['pm25_value'] for item in history]
+    filename, path = _bar_chart_path(pm25_value)
+    if os.path.exists(path):
+        return filename
+    with _CHART_LOCK:
+        _BAR_LINE.set_ydata([pm25_value, pm25_value])
+        _BAR_LINE.set_label(f'Latest Value: {pm25_value:.1f}')
+        _BAR_AX.relim()
+        _BAR_AX.autoscale_view()
+        _BAR_AX.legend()
+        _save_chart(_BAR_FIG, path)
+    prune_charts('bar_*.svg', keep=MAX_CHARTS_PER_KIND)
+    return filename
+
+def create_pm25_line_chart(pm_values):
+    if not pm_values: return None
+    filename, path = _chart_path('line', line_chart_signature(pm_values))
+    if os.path.exists(path):
+        return filename
     run_numbers = range(1, len(pm_values) + 1)
-    fig, ax = plt.subplots(figsize=(8, 4.5))
-    ax.plot(run_numbers, pm_values, marker='o', linestyle='-', color='#dc3545', label='PM2.5 Trend')
-    for i, txt in enumerate(pm_values):
-        ax.annotate(f'{txt:.1f}', (run_numbers[i], pm_values[i]), textcoords="offset points", xytext=(0,10), ha='center')
-    ax.set_ylabel('PM2.5 Concentration (µg/m³)')
-    ax.set_xlabel('Simulation Run Number')
-    ax.set_title('PM2.5 Trend from Simulation History')
-    ax.grid(axis='y', linestyle='--', alpha=0.7)
-    ax.set_xticks(run_numbers)
-    plt.tight_layout()
-    buf = BytesIO()
-    fig.savefig(buf, format="png")
-    data = base64.b64encode(buf.getbuffer()).decode("ascii")
-    plt.close(fig)
-    return data
+    fig, ax = _LINE_FIG, _LINE_AX
+    with _CHART_LOCK:
+        ax.clear()
+        ax.plot(run_numbers, pm_values, marker='o', linestyle='-', color='#dc3545', label='PM2.5 Trend')
+        # Label only the min, max and latest points so long histories don't create one Text artist per run.
+        for i in {pm_values.index(min(pm_values)), pm_values.index(max(pm_values)), len(pm_values) - 1}:
+            ax.annotate(f'{pm_values[i]:.1f}', (run_numbers[i], pm_values[i]), textcoords="offset points", xytext=(0,10), ha='center')
+        ax.set_ylabel('PM2.5 Concentration (µg/m³)')
+        ax.set_xlabel('Simulation Run Number')
+        ax.set_title('PM2.5 Trend from Simulation History')
+        ax.grid(axis='y', linestyle='--', alpha=0.7)
+        ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+        fig.tight_layout()
+        _save_chart(fig, path)
+    prune_charts('line_*.svg', keep=MAX_CHARTS_PER_KIND)
+    return filename
 
-def calculate_and_analyze_pm25(traffic, industry, burning, wind):
+def _pm25_kernel(traffic, industry, burning, wind):
+    """Dispersion model: source total divided by wind dilution. Works on scalars and NumPy arrays alike."""
     total_sources = BASE_PM25_LEVEL + (traffic * TRAFFIC_FACTOR) + (industry * INDUSTRY_FACTOR) + (burning * BURNING_FACTOR)
-    wind_dispersion = 1 + (wind * WIND_DISPERSION_FACTOR)
-    calculated_pm25 = total_sources / wind_dispersion
-    if 0 <= calculated_pm25 <= 12.0: level, msg, css = "ดี", "คุณภาพอากาศดีมาก", "good"
-    elif 12.1 <= calculated_pm25 <= 35.4: level, msg, css = "ปานกลาง", "ผู้ที่ต้องดูแลสุขภาพเป็นพิเศษควรลดเวลาทำกิจกรรมกลางแจ้ง", "fair"
-    elif 35.5 <= calculated_pm25 <= 55.4: level, msg, css = "เริ่มมีผลกระทบต่อสุขภาพ", "กลุ่มเสี่ยงควรลดเวลาทำกิจกรรมกลางแจ้ง", "poor"
-    else: level, msg, css = "มีผลกระทบต่อสุขภาพ", "ทุกคนควรเฝ้าระวังและลดเวลาการทำกิจกรรมกลางแจ้ง", "poor"
+    return total_sources / (1 + (wind * WIND_DISPERSION_FACTOR))
+
+def calculate_and_analyze_pm25(traffic, industry, burning, wind):
+    calculated_pm25 = _pm25_kernel(traffic, industry, burning, wind)
+    # Negative values are outside every band and, as before, get the most cautious level.
+    level, msg, css = _LEVELS[-1] if calculated_pm25 < 0 else _LEVELS[bisect_left(_THRESHOLDS, calculated_pm25)]
     return {"calculated_pm25": calculated_pm25, "level": level, "message": msg, "css_class": css}
 
 def generate_analytical_summary(base, scenario, base_res, scenario_res):
     parts = []
-    if scenario['traffic'] > base['traffic']: parts.append("ปริมาณรถที่เพิ่มขึ้น")
-    if scenario['burning'] > base['burning']: parts.append("การเผาที่เพิ่มขึ้น")
-    if scenario['wind'] < base['wind']: parts.append("ความเร็วลมที่ลดลง")
+    if scenario.traffic > base.traffic: parts.append("ปริมาณรถที่เพิ่มขึ้น")
+    if scenario.burning > base.burning: parts.append("การเผาที่เพิ่มขึ้น")
+    if scenario.wind < base.wind: parts.append("ความเร็วลมที่ลดลง")
     if not parts: return None
     change = ((scenario_res['calculated_pm25'] - base_res['calculated_pm25']) / base_res['calculated_pm25']) * 100 if base_res['calculated_pm25'] > 0 else 0
     return f"จากการจำลองเมื่อเงื่อนไขเปลี่ยน ({', '.join(parts)}) ส่งผลให้ PM2.5 เปลี่ยนแปลงประมาณ {change:.1f}%"
 
 def generate_detailed_analysis(inputs, result):
     analysis_points = []
-    sources = {'การจราจร': inputs['traffic'] * TRAFFIC_FACTOR, 'ภาคอุตสาหกรรม': inputs['industry'] * INDUSTRY_FACTOR, 'การเผาในที่โล่ง': inputs['burning'] * BURNING_FACTOR}
+    sources = {'การจราจร': inputs.traffic * TRAFFIC_FACTOR, 'ภาคอุตสาหกรรม': inputs.industry * INDUSTRY_FACTOR, 'การเผาในที่โล่ง': inputs.burning * BURNING_FACTOR}
     if sum(sources.values()) > 0: analysis_points.append(f"ปัจจัยหลักที่ส่งผลต่อค่าฝุ่นในสถานการณ์นี้คือ '<strong>{max(sources, key=sources.get)}</strong>'.")
-    if inputs['wind'] < 5 and result['calculated_pm25'] > 12.0: analysis_points.append("ความเร็วลมที่ค่อนข้างต่ำทำให้มลพิษกระจายตัวได้ไม่ดี ส่งผลให้ค่า PM2.5 สูงขึ้น")
+    if inputs.wind < 5 and result['calculated_pm25'] > 12.0: analysis_points.append("ความเร็วลมที่ค่อนข้างต่ำทำให้มลพิษกระจายตัวได้ไม่ดี ส่งผลให้ค่า PM2.5 สูงขึ้น")
     current_pm25 = result['calculated_pm25']
-    if inputs['wind'] < 15 and current_pm25 > 35.4:
-        hypo_wind = inputs['wind'] + 8
-        hypo_inputs = inputs.copy(); hypo_inputs['wind'] = hypo_wind
-        total_sources = BASE_PM25_LEVEL + (hypo_inputs['traffic'] * TRAFFIC_FACTOR) + (hypo_inputs['industry'] * INDUSTRY_FACTOR) + (hypo_inputs['burning'] * BURNING_FACTOR)
-        hypo_pm25 = total_sources / (1 + (hypo_inputs['wind'] * WIND_DISPERSION_FACTOR))
-        if hypo_pm25 < current_pm25:
-            reduc_pct = ((current_pm25 - hypo_pm25) / current_pm25) * 100
-            analysis_points.append(f"หากความเร็วลมเพิ่มขึ้นเป็น <strong>{hypo_wind:.1f} km/h</strong> คาดว่าค่า PM2.5 จะลดลงประมาณ <strong>{reduc_pct:.1f}%</strong>.")
+    unhealthy_from = _THRESHOLDS[1]
+    if inputs.wind < 15 and current_pm25 > unhealthy_from:
+        # Sweep 64 candidate wind speeds at once; PM2.5 falls as wind rises, so -pm is ascending.
+        winds = np.linspace(inputs.wind, inputs.wind + 20, 64, dtype=np.float32)
+        hypo_pm25 = _pm25_kernel(*inputs._replace(wind=winds))
+        idx = int(np.searchsorted(-hypo_pm25, -unhealthy_from))
+        if idx < len(winds):
+            reduc_pct = ((current_pm25 - float(hypo_pm25[idx])) / current_pm25) * 100
+            analysis_points.append(f"หากความเร็วลมเพิ่มขึ้นเป็น <strong>{float(winds[idx]):.1f} km/h</strong> คาดว่าค่า PM2.5 จะลดลงประมาณ <strong>{reduc_pct:.1f}%</strong> จนไม่เกิน {unhealthy_from} µg/m³.")
+        elif hypo_pm25[-1] < current_pm25:
+            reduc_pct = ((current_pm25 - float(hypo_pm25[-1])) / current_pm25) * 100
+            analysis_points.append(f"แม้ความเร็วลมจะเพิ่มขึ้นเป็น <strong>{float(winds[-1]):.1f} km/h</strong> ค่า PM2.5 จะลดลงเพียงประมาณ <strong>{reduc_pct:.1f}%</strong> และยังสูงกว่า {unhealthy_from} µg/m³.")
     return analysis_points if analysis_points else None
 
+def chart_urls(result, history):
+    """URLs the page uses to lazy-load its charts, so rendering them never delays the HTML."""
+    pm25_value = round(result['calculated_pm25'], 1)
+    pm_values = tuple(item['pm25_value'] for item in history)
+    sig = line_chart_signature(pm_values)
+    _issue_chart('bar', pm25_value, pm25_value)
+    _issue_chart('line', sig, pm_values)
+    # Fixed-point text rather than str(float), which switches to exponent notation for large values.
+    return url_for('bar_chart', value=f"{pm25_value:.1f}"), url_for('line_chart', sig=sig)
+
+def _send_chart(filename):
+    # Chart URLs change whenever their content does, so browsers may keep them indefinitely.
+    response = send_from_directory(CHART_DIR, filename, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route("/")
 def home(): return render_template('home.html')
 
@@ -120,66 +358,117 @@ def members():
     ]
     return render_template('members.html', members=group_members)
 
+@app.route("/chart/bar/<value>")
+def bar_chart(value):
+    try:
+        pm25_value = round(float(value), 1)
+    except ValueError:
+        abort(404)
+    if not math.isfinite(pm25_value):
+        abort(404)
+    filename, path = _bar_chart_path(pm25_value)
+    if not os.path.exists(path):
+        # Only values the app has computed are drawn, so arbitrary URLs cannot fill the disk.
+        if (_issued_chart('bar', pm25_value) is None
+                and pm25_value not in {round(item['pm25_value'], 1) for item in load_history()}):
+            abort(404)
+        create_pm25_bar_chart(pm25_value)
+    return _send_chart(filename)
+
+@app.route("/chart/line/<sig>")
+def line_chart(sig):
+    filename, path = _chart_path('line', sig)
+    if not os.path.exists(path):
+        pm_values = _issued_chart('line', sig)
+        if pm_values is None:
+            # Issued by another worker: the shared history file still identifies the current trend.
+            pm_values = tuple(item['pm25_value'] for item in load_history())
+            if not pm_values or line_chart_signature(pm_values) != sig:
+                abort(404)
+        create_pm25_line_chart(pm_values)
+    return _send_chart(filename)
+
 @app.route("/python-apps", methods=["GET", "POST"])
 def python_apps():
-    result, summary, bar_graph, line_graph, detailed_analysis = None, None, None, None, None
-    inputs = session.get('base_inputs', {})
-    history = load_history()
+    result, summary, bar_graph, line_graph, detailed_analysis, etag = None, None, None, None, None, None
+    inputs = _unpack_inputs(session['base_inputs']) if 'base_inputs' in session else None
 
     if request.method == "POST":
         action = request.form.get("action")
         if action == "clear":
             session.pop('base_inputs', None)
-            save_history([])
+            session.pop('base_pm25', None)
+            clear_history()
+            prune_charts()
+            return redirect(url_for('python_apps'))
+
+        if action != 'calculate' and action not in SCENARIO_ACTIONS:
+            return redirect(url_for('python_apps'))
+        is_scenario = action in SCENARIO_ACTIONS
+        if is_scenario and 'base_inputs' not in session:
             return redirect(url_for('python_apps'))
-        
         try:
-            if 'scenario' in action:
-                if 'base_inputs' not in session:
-                    return redirect(url_for('python_apps')) 
-                input_source = session.get('base_inputs')
+            if is_scenario:
+                current_inputs = _unpack_inputs(session['base_inputs'])
             else:
-                input_source = request.form
-
-            current_inputs = {k: float(input_source.get(k, 0)) for k in ['traffic', 'industry', 'burning', 'wind']}
-            inputs = current_inputs.copy()
-
-            if action == 'calculate':
-                session['base_inputs'] = current_inputs
-            elif action == "scenario_traffic":
-                inputs['traffic'] *= 1.5
-            elif action == "scenario_burning":
-                inputs['burning'] += 50
-            elif action == "scenario_wind":
-                inputs['wind'] *= 0.5
-
-            result = calculate_and_analyze_pm25(**inputs)
-            
-            history.append({**inputs, "pm25_value": result['calculated_pm25'], "level": result['level']})
-            save_history(history)
-            
-            detailed_analysis = generate_detailed_analysis(inputs, result)
-
-            if 'scenario' in action and 'base_inputs' in session:
-                base_result = calculate_and_analyze_pm25(**session['base_inputs'])
-                summary = generate_analytical_summary(session['base_inputs'], inputs, base_result, result)
-
-            bar_graph = create_pm25_bar_chart(result['calculated_pm25'])
-            line_graph = create_pm25_line_chart(history)
-            session.modified = True
-
-        except (ValueError, TypeError, KeyError):
+                current_inputs = Inputs._make(float(request.form.get(k, 0)) for k in Inputs._fields)
+        except (ValueError, TypeError, struct.error):
+            return redirect(url_for('python_apps'))
+        # float() accepts "inf" and "nan", which orjson would save as null.
+        if not all(math.isfinite(v) for v in current_inputs):
+            return redirect(url_for('python_apps'))
+        inputs = current_inputs
+
+        if action == "scenario_traffic":
+            inputs = inputs._replace(traffic=inputs.traffic * 1.5)
+        elif action == "scenario_burning":
+            inputs = inputs._replace(burning=inputs.burning + 50)
+        elif action == "scenario_wind":
+            inputs = inputs._replace(wind=inputs.wind * 0.5)
+
+        result = calculate_and_analyze_pm25(*inputs)
+        if not math.isfinite(result['calculated_pm25']):
             return redirect(url_for('python_apps'))
+        if action == 'calculate':
+            session['base_inputs'] = _pack_inputs(current_inputs)
+            session['base_pm25'] = result['calculated_pm25']
+
+        save_entry({**inputs._asdict(), "pm25_value": result['calculated_pm25'], "level": result['level']})
+        history = load_history()
+        history_json = orjson.dumps(history)
+
+        detailed_analysis = generate_detailed_analysis(inputs, result)
+
+        if is_scenario:
+            # Only the number is kept in the session; the level and message strings would bloat the cookie.
+            base_pm25 = session.get('base_pm25')
+            base_result = {"calculated_pm25": base_pm25} if base_pm25 is not None else calculate_and_analyze_pm25(*current_inputs)
+            summary = generate_analytical_summary(current_inputs, inputs, base_result, result)
+
+        bar_graph, line_graph = chart_urls(result, history)
+        session.modified = True
+
+    else:
+        history = load_history()
+        history_json = orjson.dumps(history) if history else None
+        if history:
+            etag = history_etag(history_json)
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+            last_run = history[-1]
+            last_inputs = Inputs._make(last_run[k] for k in Inputs._fields)
+            result = calculate_and_analyze_pm25(*last_inputs)
+            detailed_analysis = generate_detailed_analysis(last_inputs, result)
+            bar_graph, line_graph = chart_urls(result, history)
+            inputs = last_inputs
 
-    elif request.method == "GET" and history:
-        last_run = history[-1]
-        last_inputs = {k: v for k, v in last_run.items() if k in ['traffic', 'industry', 'burning', 'wind']}
-        result = calculate_and_analyze_pm25(**last_inputs)
-        detailed_analysis = generate_detailed_analysis(last_inputs, result)
-        bar_graph = create_pm25_bar_chart(result['calculated_pm25'])
-        line_graph = create_pm25_line_chart(history)
-        inputs = last_inputs
-
-    return render_template('python_apps.html', pm25_result=result, pm25_inputs=inputs, history=history, 
-                           analysis_summary=summary, bar_chart_graph=bar_graph, line_chart_graph=line_graph,
-                           detailed_analysis=detailed_analysis)
+    response = make_response(render_template('python_apps.html', pm25_result=result, pm25_inputs=inputs,
+                             history_json=history_json.decode() if history_json else None,
+                             analysis_summary=summary, bar_chart_graph=bar_graph, line_chart_graph=line_graph,
+                             detailed_analysis=detailed_analysis))
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+    return response